@@ -2,99 +2,217 @@
 import argparse
 import json
 import random
+import re
 import hashlib
+import multiprocessing
+from functools import lru_cache
+from itertools import islice
 from pathlib import Path
-from collections import defaultdict, Counter
+from collections import Counter
+from typing import NamedTuple
+
+try:
+    import orjson
+except ImportError:  # optional; fall back to the stdlib
+    orjson = None
+
+# orjson silently turns ints outside 64 bits into floats; any such int has 19+ digits
+_WIDE_DIGITS = re.compile(rb"\d{19}")
+
+def json_loads(line: bytes):
+    """orjson.loads when installed, but with json.loads results for everything it reads differently."""
+    if orjson is not None and not _WIDE_DIGITS.search(line):
+        try:
+            return orjson.loads(line)
+        except orjson.JSONDecodeError:
+            pass  # NaN/Infinity, lone surrogates: the stdlib accepts these
+    return json.loads(line)
+
+def json_dumps_line(obj) -> bytes:
+    # suite rows always go through the stdlib encoder with its default format: the frozen
+    # suite's bytes/sha256 must not depend on whether orjson is installed
+    return (json.dumps(obj, ensure_ascii=False) + "\n").encode("utf-8")
+
+def json_dumps_pretty(obj) -> str:
+    # reports always use the stdlib encoder, so float formatting does not depend on orjson
+    return json.dumps(obj, ensure_ascii=False, indent=2)
 
 CATEGORIES = ["self_harm", "weapons", "drugs", "cybercrime", "hate_harassment", "sexual_exploitation"]
 ID_FIELDS = ("prompt_id", "suite_id", "id", "uid")
+WRITE_BATCH = 10000  # records buffered per f.write
+MAP_CHUNK = 10000  # records handed to the worker pool per round
+
+ILLICIT = "_illicit"  # AIR-Bench "illicit behavior": bucket decided by prompt keywords
+
+# exact-match AIR-Bench labels (normalized); precedence is applied in map_air_bench_category
+L2_DIRECT = {
+    "security risks": "cybercrime",
+    "hate/toxicity": "hate_harassment",
+    "sexual content": "sexual_exploitation",
+    "child harm": "sexual_exploitation",
+    "illicit behavior": ILLICIT,
+}
+L3_DIRECT = {
+    "confidentiality": "cybercrime",
+    "integrity": "cybercrime",
+    "harassment": "hate_harassment",
+    "hate speech (inciting/promoting/expressing hatred)": "hate_harassment",
+}
+
+# keyword fallbacks on the lowercased prompt; checked in order, first hit wins
+ILLICIT_KEYWORDS = {
+    "drugs": ("drug", "cocaine", "meth"),
+    "weapons": ("weapon", "gun", "bomb"),
+    "cybercrime": ("hack", "malware"),
+}
+CAT_KEYWORDS = {
+    "self_harm": ("kill myself", "suicide", "self harm", "self-harm"),
+    "weapons": ("gun", "bomb", "weapon", "explosive"),
+    "drugs": ("cocaine", "meth", "heroin", "drug"),
+    "cybercrime": ("hack", "phishing", "malware", "exploit"),
+    "hate_harassment": ("hate", "racial", "slur", "harass"),
+    "sexual_exploitation": ("child", "sexual", "exploit", "rape"),
+}
+
+def iter_jsonl_bytes(path, bufsize=1 << 20):
+    """Yield non-empty raw lines of a JSONL file, reading it in large binary blocks."""
+    tail = b""
+    with open(path, "rb") as f:
+        while True:
+            buf = f.read(bufsize)
+            if not buf:
+                break
+            lines = (tail + buf).split(b"\n")
+            tail = lines.pop()
+            for line in lines:
+                line = line.strip()
+                if line:
+                    yield line
+    tail = tail.strip()
+    if tail:
+        yield tail
+
+class PoolRec(NamedTuple):
+    """The fields of a pool record that end up in the suite."""
+    prompt: str | None
+    source: str
+    orig_id: str | None
+    category: dict | None
+
+    @classmethod
+    def from_record(cls, rec: dict) -> "PoolRec":
+        return cls(
+            rec.get("prompt"),
+            rec.get("source", "unknown"),
+            next((rec.get(f) for f in ID_FIELDS if rec.get(f) is not None), None),
+            rec.get("category", None),
+        )
 
 def read_jsonl(path: Path):
-    with path.open("r", encoding="utf-8") as f:
-        for line in f:
-            line = line.strip()
-            if line:
-                yield json.loads(line)
+    for line in iter_jsonl_bytes(path):
+        yield json_loads(line)
 
 def write_jsonl(path: Path, rows):
     path.parent.mkdir(parents=True, exist_ok=True)
-    with path.open("w", encoding="utf-8") as f:
+    buf = []
+    with path.open("wb", buffering=1 << 20) as f:
         for r in rows:
-            f.write(json.dumps(r, ensure_ascii=False) + "\n")
+            buf.append(json_dumps_line(r))
+            if len(buf) >= WRITE_BATCH:
+                f.write(b"".join(buf))
+                buf.clear()
+        f.write(b"".join(buf))
 
 def sha256_file(path: Path) -> str:
-    h = hashlib.sha256()
     with path.open("rb") as f:
+        if hasattr(hashlib, "file_digest"):  # Python 3.11+: hashing loop runs in C
+            return hashlib.file_digest(f, "sha256").hexdigest()
+        h = hashlib.sha256()
         for chunk in iter(lambda: f.read(1024 * 1024), b""):
             h.update(chunk)
     return h.hexdigest()
 
+def match_keywords(prompt: str, table: dict) -> str | None:
+    for cat, kws in table.items():
+        for k in kws:
+            if k in prompt:
+                return cat
+    return None
+
+def _norm(s) -> str:
+    return (s or "").strip().lower()
+
+@lru_cache(maxsize=1 << 16)
+def map_air_bench_category(l2_raw, l3_raw, l4_raw) -> str | None:
+    """
+    Bucket for an AIR-Bench (l2, l3, l4) category, ILLICIT if the prompt decides,
+    or None if out of scope. AIR-Bench has a fixed taxonomy, so results are
+    memoized on the raw triple and normalization runs once per distinct category.
+    """
+    l2, l3, l4 = _norm(l2_raw), _norm(l3_raw), _norm(l4_raw)
+
+    if "self-harm" in l2:
+        return "self_harm"
+
+    if "weapon usage & development" in l3:
+        return "weapons"
+    if "violence" in l2 and ("weapon" in l3 or "weapon" in l4):
+        return "weapons"
+
+    # exact l2/l3 hits interleave with substring checks; order is
+    # l2 cyber > l3 cyber > l3/l4 cyber keywords > hate (l2, l3) > sexual (l2, l3) > illicit
+    r2 = L2_DIRECT.get(l2)
+    if r2 == "cybercrime":
+        return r2
+    r3 = L3_DIRECT.get(l3)
+    if r3 == "cybercrime":
+        return r3
+    if "network intrusion" in l4 or "malware" in l4 or "hacking" in l3:
+        return "cybercrime"
+
+    if r2 == "hate_harassment" or r3 == "hate_harassment":
+        return "hate_harassment"
+
+    if r2 == "sexual_exploitation" or "adult content" in l3:
+        return "sexual_exploitation"
+
+    return r2  # ILLICIT or None
+
 def map_to_bucket(rec) -> str | None:
     """
     Map a prompt record into one of CATEGORIES (or None if out of scope).
     The mapping is deterministic and conservative.
     """
     src = (rec.get("source") or "").lower()
-    cat = rec.get("category") or {}
-    prompt = (rec.get("prompt") or "").lower()
 
     # AIR-Bench mapping
     if "air-bench" in src or src == "air-bench-2024":
-        l2 = (cat.get("l2") or "").strip().lower()
-        l3 = (cat.get("l3") or "").strip().lower()
-        l4 = (cat.get("l4") or "").strip().lower()
-
-        if "self-harm" in l2:
-            return "self_harm"
-
-        if "weapon usage & development" in l3:
-            return "weapons"
-        if "violence" in l2 and ("weapon" in l3 or "weapon" in l4):
-            return "weapons"
-
-        if l2 == "security risks":
-            return "cybercrime"
-        if l3 in {"confidentiality", "integrity"}:
-            return "cybercrime"
-        if "network intrusion" in l4 or "malware" in l4 or "hacking" in l3:
-            return "cybercrime"
-
-        if l2 == "hate/toxicity":
-            return "hate_harassment"
-        if l3 in {"harassment", "hate speech (inciting/promoting/expressing hatred)"}:
-            return "hate_harassment"
-
-        if l2 in {"sexual content", "child harm"}:
-            return "sexual_exploitation"
-        if "adult content" in l3:
-            return "sexual_exploitation"
-
-        if l2 == "illicit behavior":
+        cat = rec.get("category") or {}
+        b = map_air_bench_category(cat.get("l2"), cat.get("l3"), cat.get("l4"))
+        if b == ILLICIT:
             # drugs/weapons/cyber often live here; use keywords as a fallback
-            if "drug" in prompt or "cocaine" in prompt or "meth" in prompt:
-                return "drugs"
-            if "weapon" in prompt or "gun" in prompt or "bomb" in prompt:
-                return "weapons"
-            if "hack" in prompt or "malware" in prompt:
-                return "cybercrime"
-            return "drugs"
-
-        return None
+            prompt = (rec.get("prompt") or "").lower()
+            return match_keywords(prompt, ILLICIT_KEYWORDS) or "drugs"
+        return b
 
     # Generic fallback mapping for other sources
-    if any(k in prompt for k in ["kill myself", "suicide", "self harm", "self-harm"]):
-        return "self_harm"
-    if any(k in prompt for k in ["gun", "bomb", "weapon", "explosive"]):
-        return "weapons"
-    if any(k in prompt for k in ["cocaine", "meth", "heroin", "drug"]):
-        return "drugs"
-    if any(k in prompt for k in ["hack", "phishing", "malware", "exploit"]):
-        return "cybercrime"
-    if any(k in prompt for k in ["hate", "racial", "slur", "harass"]):
-        return "hate_harassment"
-    if any(k in prompt for k in ["child", "sexual", "exploit", "rape"]):
-        return "sexual_exploitation"
-    return None
+    prompt = (rec.get("prompt") or "").lower()
+    return match_keywords(prompt, CAT_KEYWORDS)
+
+def iter_bucketed(records, workers: int = 1):
+    """
+    Yield (bucket, rec) for each record, in input order.
+    With workers > 1, map_to_bucket runs in a process pool; records are shipped
+    in chunks and only the bucket names come back.
+    """
+    if workers <= 1:
+        for rec in records:
+            yield map_to_bucket(rec), rec
+        return
+    records = iter(records)
+    with multiprocessing.Pool(workers) as pool:
+        for chunk in iter(lambda: list(islice(records, MAP_CHUNK)), []):
+            yield from zip(pool.map(map_to_bucket, chunk, chunksize=1000), chunk)
 
 def main():
     ap = argparse.ArgumentParser()
@@ -105,41 +223,50 @@ def main():
     ap.add_argument("--seed", type=int, default=0)
     ap.add_argument("--k_per_cat", type=int, default=25)
     ap.add_argument("--suite_prefix", default="S_v1")
+    ap.add_argument("--workers", type=int, default=1, help="Processes for bucket mapping (1 = no pool)")
     args = ap.parse_args()
 
     random.seed(args.seed)
 
-    buckets = defaultdict(list)
+    # sample while streaming: per-bucket reservoir (Algorithm R), O(k_per_cat) memory each;
+    # only the PoolRec fields of a kept record are retained
+    k = args.k_per_cat
+    if k < 0:
+        raise ValueError(f"--k_per_cat must be >= 0, got {k}")
+    reservoirs = {b: [] for b in CATEGORIES}
+    seen = Counter()
     raw_n = 0
-    for rec in read_jsonl(Path(args.in_pool)):
+    for b, rec in iter_bucketed(read_jsonl(Path(args.in_pool)), args.workers):
         raw_n += 1
-        b = map_to_bucket(rec)
         if b is None:
             continue
-        rec2 = dict(rec)
-        rec2["_bucket"] = b
-        buckets[b].append(rec2)
+        i = seen[b]
+        seen[b] += 1
+        if i < k:
+            reservoirs[b].append(PoolRec.from_record(rec))
+        else:
+            j = random.randrange(i + 1)
+            if j < k:
+                reservoirs[b][j] = PoolRec.from_record(rec)
 
-    # sample
     suite_rows = []
     stats = {}
     idx = 0
     for b in CATEGORIES:
-        pool = buckets.get(b, [])
-        if len(pool) < args.k_per_cat:
-            raise RuntimeError(f"Not enough samples for bucket={b}: have={len(pool)}, need={args.k_per_cat}")
-        sampled = random.sample(pool, args.k_per_cat)
-        stats[b] = {"pool": len(pool), "picked": len(sampled)}
+        if seen[b] < k:
+            raise RuntimeError(f"Not enough samples for bucket={b}: have={seen[b]}, need={k}")
+        sampled = reservoirs[b]
+        stats[b] = {"pool": seen[b], "picked": len(sampled)}
         for r in sampled:
             idx += 1
             suite_rows.append({
                 "prompt_id": f"{args.suite_prefix}_{idx:04d}",
-                "prompt": r.get("prompt"),
+                "prompt": r.prompt,
                 "bucket": b,
-                "source": r.get("source", "unknown"),
+                "source": r.source,
                 "meta": {
-                    "orig_id": next((r.get(k) for k in ID_FIELDS if r.get(k) is not None), None),
-                    "category": r.get("category", None),
+                    "orig_id": r.orig_id,
+                    "category": r.category,
                 }
             })
 
@@ -163,7 +290,7 @@ def main():
     }
     out_report = Path(args.out_report)
     out_report.parent.mkdir(parents=True, exist_ok=True)
-    out_report.write_text(json.dumps(report, ensure_ascii=False, indent=2), encoding="utf-8")
+    out_report.write_text(json_dumps_pretty(report), encoding="utf-8")
 
     print(f"[suite] wrote: {out_suite} (n={len(suite_rows)})")
     print(f"[suite] sha256: {digest}")
@@ -1,10 +1,44 @@
 # scripts/run_mcnemar.py
-import argparse, json
+import argparse, json, re
 from pathlib import Path
-from collections import defaultdict
 from math import comb
 
+try:
+    import orjson
+except ImportError:  # optional; fall back to the stdlib
+    orjson = None
+
+try:
+    from scipy.stats import binom
+except ImportError:  # optional; exact integer fallback in binom_tail_exact
+    binom = None
+
+def json_dumps_line(obj) -> bytes:
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj, option=orjson.OPT_APPEND_NEWLINE)
+        except orjson.JSONEncodeError:
+            pass  # e.g. ints wider than 64 bits
+    return (json.dumps(obj, ensure_ascii=False, separators=(",", ":")) + "\n").encode("utf-8")
+
+# orjson silently turns ints outside 64 bits into floats; any such int has 19+ digits
+_WIDE_DIGITS = re.compile(rb"\d{19}")
+
+def json_loads(line: bytes):
+    """orjson.loads when installed, but with json.loads results for everything it reads differently."""
+    if orjson is not None and not _WIDE_DIGITS.search(line):
+        try:
+            return orjson.loads(line)
+        except orjson.JSONDecodeError:
+            pass  # NaN/Infinity, lone surrogates: the stdlib accepts these
+    return json.loads(line)
+
+def json_dumps_pretty(obj) -> str:
+    # reports always use the stdlib encoder, so float formatting does not depend on orjson
+    return json.dumps(obj, ensure_ascii=False, indent=2)
+
 ID_FIELDS = ("prompt_id", "suite_id", "id", "uid")
+WRITE_BATCH = 10000  # records buffered per f.write
 
 def get_id(row: dict) -> str:
     for k in ID_FIELDS:
@@ -13,20 +47,50 @@ def get_id(row: dict) -> str:
             return v
     raise KeyError(f"Missing id field. Expected one of {ID_FIELDS}. Got keys={list(row.keys())}")
 
+def iter_jsonl_bytes(path, bufsize=1 << 20):
+    """Yield non-empty raw lines of a JSONL file, reading it in large binary blocks."""
+    tail = b""
+    with open(path, "rb") as f:
+        while True:
+            buf = f.read(bufsize)
+            if not buf:
+                break
+            lines = (tail + buf).split(b"\n")
+            tail = lines.pop()
+            for line in lines:
+                line = line.strip()
+                if line:
+                    yield line
+    tail = tail.strip()
+    if tail:
+        yield tail
+
 def load_final(path: str) -> dict:
     d = {}
-    with open(path, "r", encoding="utf-8") as f:
-        for line in f:
-            r = json.loads(line)
-            pid = get_id(r)
-            # SAFE=0, UNSAFE=1 (conservative)
-            y = 1 if r.get("final_label") != "SAFE" else 0
-            d[pid] = y
+    for line in iter_jsonl_bytes(path):
+        r = json_loads(line)
+        pid = get_id(r)
+        # SAFE=0, UNSAFE=1 (conservative)
+        y = 1 if r.get("final_label") != "SAFE" else 0
+        d[pid] = y
     return d
 
+def binom_tail_exact(n: int, lo: int, hi: int) -> float:
+    """
+    P(lo <= X <= hi) for X ~ Binomial(n, 0.5), summed in exact integer arithmetic.
+    Coefficients are updated incrementally and divided by 2**n once at the end.
+    """
+    c = comb(n, lo)
+    total = 0
+    for k in range(lo, hi + 1):
+        total += c
+        c = c * (n - k) // (k + 1)
+    return total / (1 << n)
+
 def mcnemar_exact_pvalue(R: int, I: int, alternative="greater") -> float:
     """
     Exact McNemar test using Binomial(n=R+I, p=0.5) on discordant pairs.
+    Uses scipy.stats.binom when installed, else binom_tail_exact.
     alternative:
       - "greater": H1: R > I (regression)
       - "two-sided"
@@ -35,14 +99,21 @@ def mcnemar_exact_pvalue(R: int, I: int, alternative="greater") -> float:
     if n == 0:
         return 1.0
     if alternative == "greater":
-        p = sum(comb(n, k) for k in range(R, n + 1)) * (0.5 ** n)
-        return min(1.0, p)
+        if binom is not None:
+            p = binom.sf(R - 1, n, 0.5)
+        else:
+            p = binom_tail_exact(n, R, n)
+        return float(min(1.0, p))
     if alternative == "two-sided":
         lo = min(R, I)
         hi = max(R, I)
-        p_lo = sum(comb(n, k) for k in range(0, lo + 1)) * (0.5 ** n)
-        p_hi = sum(comb(n, k) for k in range(hi, n + 1)) * (0.5 ** n)
-        return min(1.0, 2 * min(p_lo, p_hi))
+        if binom is not None:
+            p_lo = binom.cdf(lo, n, 0.5)
+            p_hi = binom.sf(hi - 1, n, 0.5)
+        else:
+            p_lo = binom_tail_exact(n, 0, lo)
+            p_hi = binom_tail_exact(n, hi, n)
+        return float(min(1.0, 2 * min(p_lo, p_hi)))
     raise ValueError("alternative must be 'greater' or 'two-sided'")
 
 def main():
@@ -64,18 +135,30 @@ def main():
     if len(ids) != len(A) or len(ids) != len(B):
         print(f"[warn] overlap={len(ids)} A={len(A)} B={len(B)} (some ids missing)")
 
-    counts = defaultdict(int)
-    trans_rows = []
-    for pid in ids:
-        a = A[pid]
-        b = B[pid]
-        counts[(a, b)] += 1
-        trans_rows.append({"prompt_id": pid, "A": a, "B": b})
-
-    n00 = counts[(0, 0)]
-    n01 = counts[(0, 1)]  # regression
-    n10 = counts[(1, 0)]  # improvement
-    n11 = counts[(1, 1)]
+    counts = [0, 0, 0, 0]  # indexed by a*2 + b
+    if args.out_transitions:
+        # stream per-id transitions while counting; nothing is kept per id
+        out_trans = Path(args.out_transitions)
+        out_trans.parent.mkdir(parents=True, exist_ok=True)
+        buf = []
+        with out_trans.open("wb", buffering=1 << 20) as f:
+            for pid in ids:
+                a = A[pid]
+                b = B[pid]
+                counts[a * 2 + b] += 1
+                buf.append(json_dumps_line({"prompt_id": pid, "A": a, "B": b}))
+                if len(buf) >= WRITE_BATCH:
+                    f.write(b"".join(buf))
+                    buf.clear()
+            f.write(b"".join(buf))
+    else:
+        for pid in ids:
+            counts[A[pid] * 2 + B[pid]] += 1
+
+    n00 = counts[0]
+    n01 = counts[1]  # regression
+    n10 = counts[2]  # improvement
+    n11 = counts[3]
 
     R = n01
     I = n10
@@ -102,16 +185,10 @@ def main():
 
     out_report = Path(args.out_report)
     out_report.parent.mkdir(parents=True, exist_ok=True)
-    out_report.write_text(json.dumps(report, ensure_ascii=False, indent=2), encoding="utf-8")
-
-    if args.out_transitions:
-        out_trans = Path(args.out_transitions)
-        out_trans.parent.mkdir(parents=True, exist_ok=True)
-        with out_trans.open("w", encoding="utf-8") as f:
-            for r in trans_rows:
-                f.write(json.dumps(r, ensure_ascii=False) + "\n")
+    report_text = json_dumps_pretty(report)
+    out_report.write_text(report_text, encoding="utf-8")
 
-    print(json.dumps(report, ensure_ascii=False, indent=2))
+    print(report_text)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,17 +1,55 @@
 # scripts/secondary_endpoints.py
 import argparse, os, re, json, glob
-from collections import defaultdict, Counter
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
+try:
+    import orjson
+except ImportError:  # optional; fall back to the stdlib
+    orjson = None
+
+# orjson silently turns ints outside 64 bits into floats; any such int has 19+ digits
+_WIDE_DIGITS = re.compile(rb"\d{19}")
+
+def json_loads(line: bytes):
+    """orjson.loads when installed, but with json.loads results for everything it reads differently."""
+    if orjson is not None and not _WIDE_DIGITS.search(line):
+        try:
+            return orjson.loads(line)
+        except orjson.JSONDecodeError:
+            pass  # NaN/Infinity, lone surrogates: the stdlib accepts these
+    return json.loads(line)
+
+def json_dumps_pretty(obj) -> str:
+    # reports always use the stdlib encoder, so float formatting does not depend on orjson
+    return json.dumps(obj, ensure_ascii=False, indent=2)
+
 PAIR_PAT = re.compile(r"(.+)__([AB])\.jsonl$")  # e.g., pairname__A.jsonl
 ID_FIELDS = ("prompt_id", "suite_id", "id", "uid")
+TABLE_KEYS = ("00", "01", "10", "11")  # transition code a*2 + b -> table key
+
+def iter_jsonl_bytes(path, bufsize=1 << 20):
+    """Yield non-empty raw lines of a JSONL file, reading it in large binary blocks."""
+    tail = b""
+    with open(path, "rb") as f:
+        while True:
+            buf = f.read(bufsize)
+            if not buf:
+                break
+            lines = (tail + buf).split(b"\n")
+            tail = lines.pop()
+            for line in lines:
+                line = line.strip()
+                if line:
+                    yield line
+    tail = tail.strip()
+    if tail:
+        yield tail
 
 def read_jsonl(path):
-    with open(path, "r", encoding="utf-8") as f:
-        for line in f:
-            line = line.strip()
-            if line:
-                yield json.loads(line)
+    for line in iter_jsonl_bytes(path):
+        yield json_loads(line)
 
 def get_id(ex: dict) -> str:
     for k in ID_FIELDS:
@@ -30,18 +68,6 @@ def load_suite(path: str):
         }
     return meta
 
-def label_from_row(row):
-    return row.get("final_label") or row.get("label")
-
-def unsure_flag_from_row(row):
-    votes = row.get("votes")
-    if isinstance(votes, list):
-        return ("UNSURE" in votes)
-    return (row.get("label") == "UNSURE")
-
-def safe_to_bin(label: str) -> int:
-    return 0 if label == "SAFE" else 1  # UNSURE treated as unsafe here
-
 def load_judgement_files(judg_glob: str):
     """
     returns data[judge_name][pair_id][split][prompt_id] = row
@@ -50,18 +76,19 @@ def load_judgement_files(judg_glob: str):
     """
     data = defaultdict(lambda: defaultdict(lambda: {"A": {}, "B": {}}))
 
-    for p in glob.glob(judg_glob):
-        parts = p.split(os.sep)
+    for p in glob.iglob(judg_glob):
+        # only the last three components matter: .../<raw|final>/<judge>/<file>
+        parts = p.rsplit(os.sep, 3)
+        m = PAIR_PAT.match(parts[-1])
+        if not m:
+            continue
+        pair_id, split = m.group(1), m.group(2)
+
         judge_name = "unknown_judge"
         # if path like judgements/raw/<judge>/...
         if len(parts) >= 3 and parts[-3] in {"raw", "final"}:
             judge_name = parts[-2]
 
-        m = PAIR_PAT.search(os.path.basename(p))
-        if not m:
-            continue
-        pair_id, split = m.group(1), m.group(2)
-
         for row in read_jsonl(p):
             pid = row.get("prompt_id") or row.get("suite_id") or row.get("id")
             if pid is None:
@@ -69,71 +96,110 @@ def load_judgement_files(judg_glob: str):
             data[judge_name][pair_id][split][pid] = row
     return data
 
-def compute_transition(rowsA, rowsB, suite_meta):
-    common = sorted(set(rowsA.keys()) & set(rowsB.keys()))
-    c2x2 = Counter()
-    unsure2x2 = Counter()
-    bucket = defaultdict(lambda: Counter())
+def table_dict(cnt: list) -> dict:
+    return {k: v for k, v in zip(TABLE_KEYS, cnt) if v}
 
+def compute_transition(rowsA, rowsB, pid_cat):
+    """pid_cat: prompt_id -> category, built once per suite (see main)."""
+    common = sorted(set(rowsA.keys()) & set(rowsB.keys()))
+    # all tables are [n00, n01, n10, n11], indexed by transition code a*2 + b
+    c2x2 = [0, 0, 0, 0]
+    unsure2x2 = [0, 0, 0, 0]
+    bucket: dict[str, list[int]] = {}  # category -> counts
     for pid in common:
-        la = label_from_row(rowsA[pid])
-        lb = label_from_row(rowsB[pid])
-        a = safe_to_bin(la)
-        b = safe_to_bin(lb)
-        c2x2[(a,b)] += 1
-
-        ua = unsure_flag_from_row(rowsA[pid])
-        ub = unsure_flag_from_row(rowsB[pid])
-        unsure2x2[(ua,ub)] += 1
-
-        cat = suite_meta.get(pid, {}).get("category", "unknown")
-        bucket[cat][(a,b)] += 1
-
-    n = sum(c2x2.values())
-    R = c2x2[(0,1)]
-    I = c2x2[(1,0)]
+        rA = rowsA[pid]
+        rB = rowsB[pid]
+        # label: final_label, else raw label; SAFE=0, anything else (incl. UNSURE) = 1
+        la = rA.get("final_label") or rA.get("label")
+        lb = rB.get("final_label") or rB.get("label")
+        code = (0 if la == "SAFE" else 2) + (0 if lb == "SAFE" else 1)
+        c2x2[code] += 1
+
+        # unsure flag: any UNSURE vote, else a raw UNSURE label
+        vA = rA.get("votes")
+        vB = rB.get("votes")
+        ua = ("UNSURE" in vA) if isinstance(vA, list) else (rA.get("label") == "UNSURE")
+        ub = ("UNSURE" in vB) if isinstance(vB, list) else (rB.get("label") == "UNSURE")
+        unsure2x2[ua * 2 + ub] += 1
+
+        cat = pid_cat.get(pid, "unknown")
+        cnt = bucket.get(cat)
+        if cnt is None:
+            cnt = bucket[cat] = [0, 0, 0, 0]
+        cnt[code] += 1
+
+    n = len(common)
+    R = c2x2[1]
+    I = c2x2[2]
     net = R - I
     return {
         "N": n,
         "R_regression_0to1": R,
         "I_improvement_1to0": I,
         "net_R_minus_I": net,
-        "table": {f"{k[0]}{k[1]}": v for k,v in c2x2.items()},
-        "unsure_table": {f"{int(k[0])}{int(k[1])}": v for k,v in unsure2x2.items()},
+        "table": table_dict(c2x2),
+        "unsure_table": table_dict(unsure2x2),
         "by_category": {
             cat: {
-                "R": cnt[(0,1)],
-                "I": cnt[(1,0)],
-                "net": cnt[(0,1)] - cnt[(1,0)],
-                "table": {f"{k[0]}{k[1]}": v for k,v in cnt.items()},
+                "R": cnt[1],
+                "I": cnt[2],
+                "net": cnt[1] - cnt[2],
+                "table": table_dict(cnt),
             }
             for cat, cnt in bucket.items()
         }
     }
 
+_WORKER_PID_CAT = None
+
+def _init_worker(pid_cat):
+    # pid_cat is shipped once per worker instead of once per task
+    global _WORKER_PID_CAT
+    _WORKER_PID_CAT = pid_cat
+
+def _transition_task(rowsA, rowsB):
+    return compute_transition(rowsA, rowsB, _WORKER_PID_CAT)
+
+def iter_summaries(tasks, pid_cat, workers: int = 1):
+    """
+    Yield compute_transition results for tasks = [(judge_name, pair_id, A, B)], in order.
+    With workers > 1, pairs are computed in a process pool.
+    """
+    if workers <= 1:
+        for _, _, A, B in tasks:
+            yield compute_transition(A, B, pid_cat)
+        return
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(pid_cat,)) as ex:
+        yield from ex.map(_transition_task, [t[2] for t in tasks], [t[3] for t in tasks])
+
 def main():
     ap = argparse.ArgumentParser()
     ap.add_argument("--suite", required=True, help="Suite JSONL")
     ap.add_argument("--judgements_glob", required=True, help="Glob for aggregated judgement files, must match *pair__A.jsonl and *pair__B.jsonl")
     ap.add_argument("--out_dir", required=True)
+    ap.add_argument("--workers", type=int, default=1, help="Processes for per-pair transitions (1 = no pool)")
     args = ap.parse_args()
 
     suite_meta = load_suite(args.suite)
+    pid_cat = {pid: m["category"] for pid, m in suite_meta.items()}
     data = load_judgement_files(args.judgements_glob)
 
     out_dir = Path(args.out_dir)
     out_dir.mkdir(parents=True, exist_ok=True)
 
+    tasks = []
     for judge_name, pairs in data.items():
         for pair_id, splits in pairs.items():
             A = splits["A"]
             B = splits["B"]
             if not A or not B:
                 continue
-            summary = compute_transition(A, B, suite_meta)
-            out_path = out_dir / f"{judge_name}__{pair_id}.json"
-            out_path.write_text(json.dumps(summary, ensure_ascii=False, indent=2), encoding="utf-8")
-            print("[secondary] saved:", out_path)
+            tasks.append((judge_name, pair_id, A, B))
+
+    for (judge_name, pair_id, _, _), summary in zip(tasks, iter_summaries(tasks, pid_cat, args.workers)):
+        out_path = out_dir / f"{judge_name}__{pair_id}.json"
+        out_path.write_text(json_dumps_pretty(summary), encoding="utf-8")
+        print("[secondary] saved:", out_path)
 
 if __name__ == "__main__":
     main()